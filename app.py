@@ -1,16 +1,24 @@
 # app.py (Versão Refatorada - Design System NT Transportes)
 
 import bcrypt
-import locale
+import hashlib
 import gspread
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime, date
-from sqlalchemy import create_engine, text
+from datetime import date
+from sqlalchemy import create_engine, make_url, text
+from sqlalchemy.pool import NullPool
 from zoneinfo import ZoneInfo
 import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ==============================================================================
 # 🎨 DESIGN TOKENS E CONFIGURAÇÃO DA PÁGINA
@@ -22,6 +30,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# O Streamlit reexecuta este script inteiro a cada interação: as constantes de módulo (cores, CSS, templates HTML, mapas)
+# são remontadas a cada rerun e só evitam repetir trabalho dentro de uma mesma execução. O que precisa sobreviver
+# entre reruns fica em st.cache_data/st.cache_resource ou st.session_state.
 C = {
     "deep":   "#0D1B2A",
     "mid":    "#1E3A5F",
@@ -35,8 +46,8 @@ C = {
 }
 
 # --- CSS Global ---
-st.markdown(
-    f"""<style>
+# Folha de estilo fixa: montada numa única constante e enviada com uma chamada por execução
+CSS_GLOBAL = f"""<style>
     @import url('https://fonts.googleapis.com/css2?family=IBM+Plex+Sans:wght@300;400;600;700&family=IBM+Plex+Mono:wght@400;500;700&display=swap');
     html, body, [class*="css"] {{ font-family: 'IBM Plex Sans', sans-serif !important; }}
     
@@ -50,28 +61,30 @@ st.markdown(
         padding: 12px; font-size: 0.95rem; font-weight: 600; color: {C['mid']};
     }}
     div[data-testid="stExpander"] summary:hover {{ background-color: #f1f3f5; }}
-    </style>""",
-    unsafe_allow_html=True,
-)
+    </style>"""
+st.markdown(CSS_GLOBAL, unsafe_allow_html=True)
 
 # ==============================================================================
 # 🛠️ HELPERS DE INTERFACE (UI)
 # ==============================================================================
-def kpi_card(col, icon: str, label: str, value: str, sub: str = "", accent: str = "#00B4D8"):
-    col.markdown(
-        f"""<div style="background:#fff; border:1px solid {C['border']}; 
-                border-top:4px solid {accent}; border-radius:12px; 
+# Estilos fixos interpolados uma vez por execução do script; cada kpi_card só preenche os campos variáveis
+_KPI_TMPL = f"""<div style="background:#fff; border:1px solid {C['border']}; 
+                border-top:4px solid {{accent}}; border-radius:12px; 
                 padding:18px 20px 14px 20px; height: 100%;
                 box-shadow:0 2px 8px rgba(0,0,0,0.04);">
-            <div style="font-size:1.25rem; margin-bottom:4px;">{icon}</div>
+            <div style="font-size:1.25rem; margin-bottom:4px;">{{icon}}</div>
             <div style="font-size:0.67rem; font-weight:700; letter-spacing:0.07em; 
                         text-transform:uppercase; color:{C['muted']}; margin-bottom:5px;">
-                {label}</div>
+                {{label}}</div>
             <div style="font-size:1.45rem; font-weight:700; color:{C['deep']}; 
                         font-family:'IBM Plex Mono',monospace; line-height:1.15;">
-                {value}</div>
-            <div style="font-size:0.75rem; color:{C['muted']}; margin-top:8px;">{sub}</div>
-        </div>""",
+                {{value}}</div>
+            <div style="font-size:0.75rem; color:{C['muted']}; margin-top:8px;">{{sub}}</div>
+        </div>""".format_map
+
+def kpi_card(col, icon: str, label: str, value: str, sub: str = "", accent: str = "#00B4D8"):
+    col.markdown(
+        _KPI_TMPL({'icon': icon, 'label': label, 'value': value, 'sub': sub, 'accent': accent}),
         unsafe_allow_html=True,
     )
 
@@ -102,28 +115,59 @@ def plotly_layout(**kw) -> dict:
 # ==============================================================================
 # 🔐 AUTENTICAÇÃO E CONEXÃO DB
 # ==============================================================================
+@st.cache_resource
+def criar_engine(connection_string):
+    # O Streamlit reexecuta o script a cada interação: o cache_resource mantém um único pool por processo
+    url = make_url(connection_string)
+    if url.port == 6543:
+        # Transaction pooler do Supabase (pgbouncer) já faz o pooling; conexões não podem ser reaproveitadas
+        return create_engine(url, poolclass=NullPool, pool_pre_ping=True)
+    return create_engine(url, pool_size=3, max_overflow=2, pool_pre_ping=True, pool_recycle=1800, pool_timeout=30)
+
 try:
-    connection_string = st.secrets["supabase"]["connection_string"]
-    engine = create_engine(connection_string)
+    engine = criar_engine(st.secrets["supabase"]["connection_string"])
 except Exception as e:
     st.error(f"Erro ao conectar ao banco de dados: {e}")
     engine = None
 
+@st.cache_resource
+def obter_cliente_gs():
+    # Um único cliente autenticado por processo: evita refazer o fluxo OAuth da service account a cada carga
+    return gspread.service_account_from_dict(dict(st.secrets["gcp_service_account"]))
+
+SHEETS_MAX_TENTATIVAS, SHEETS_ESPERA_MAX_S = 5, 30
+
+def com_retentativa(chamada):
+    # Erros transitórios da API do Sheets (cota 429, timeout 408, 5xx) são repetidos com espera exponencial
+    # limitada; o estado é local a cada chamada (o cliente em cache é compartilhado entre sessões e threads).
+    # Qualquer outro erro, ou o último, sobe para o st.error do loader
+    for tentativa in range(SHEETS_MAX_TENTATIVAS):
+        try: return chamada()
+        except gspread.exceptions.APIError as e:
+            codigo = e.response.status_code
+            if tentativa == SHEETS_MAX_TENTATIVAS - 1 or not (codigo in (408, 429) or codigo >= 500): raise
+            time.sleep(min(2 ** tentativa, SHEETS_ESPERA_MAX_S))
+
 def verify_password(plain_password: str, hashed_password_from_db: bytes) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password_from_db)
 
+# Só a linha do usuário fica em cache (TTL curto, compartilhado entre sessões): troca de senha ou cadastro
+# desativado valem em até 30 s. A senha nunca entra na chave e o bcrypt roda em toda tentativa.
+# Erros de banco sobem como exceção e por isso não ficam em cache
+@st.cache_data(ttl=30, max_entries=256, show_spinner=False)
+def buscar_usuario(email):
+    with engine.connect() as conn:
+        # lower(email) casa com o índice funcional usuarios_email_lower_uq (sql/indices.sql): busca por índice, não seqscan
+        query = text("SELECT id, nome, email, senha, departamento FROM usuarios WHERE lower(email) = lower(:email)")
+        result = conn.execute(query, {"email": email}).fetchone()
+    return dict(result._mapping) if result else None
+
 def authenticate_user(email, senha):
-    if not email or not senha: return None
-    if not engine: return None
+    if not email or not senha or not engine: return None
     try:
-        with engine.connect() as conn:
-            query = text("SELECT id, nome, email, senha, departamento FROM usuarios WHERE email = :email")
-            result = conn.execute(query, {"email": email}).fetchone()
-            if result:
-                user_data = dict(result._mapping)
-                if verify_password(senha, user_data['senha'].encode('utf-8')):
-                    del user_data['senha']
-                    return user_data
+        user_data = buscar_usuario(email.lower())
+        if user_data and verify_password(senha, user_data.pop('senha').encode('utf-8')):
+            return user_data
     except Exception as e:
         st.error(f"Erro na autenticação: {e}")
     return None
@@ -141,44 +185,145 @@ DEPARTAMENTOS_AUTORIZADOS_PARA_ACOES = ["gerencia", "master", "rh"]
 # ==============================================================================
 # 🔄 FUNÇÕES DE DADOS (PANDAS E DB)
 # ==============================================================================
+COLUNAS_ANOTACAO = ['nome_usuario', 'categoria', 'justificativa']
+# Colunas da planilha de HE agrupadas pela conversão que recebem no loader
+COLUNAS_VALOR = ('valor_he_50%', 'valor_he_100%', 'valor_total')
+COLUNAS_QTD = ('qtd_he_50%', 'qtd_he_100%')
+COLUNAS_CATEGORIA = ('nome', 'cargo', 'funcao')
+
+def chave_registro(ids):
+    # Hash int64 do id textual (PK em anotacoes): o merge compara inteiros em vez de strings longas
+    return pd.util.hash_pandas_object(ids, index=False)
+
+def mesclar_anotacoes(df, df_anotacoes):
+    # Regrava só as colunas de anotação no próprio frame: as demais colunas não são realocadas
+    # (nem no carregamento inicial, nem a cada salvamento em reset_app_state)
+    if '_chave' not in df.columns:
+        df['_chave'] = chave_registro(df['id_registro_original'])
+    if df_anotacoes.empty:
+        for col in COLUNAS_ANOTACAO: df[col] = ''
+        return df
+    # Anotações já chegam indexadas por _chave (índice único montado no loader em cache)
+    # NULLs já viram '' no loader; linhas sem anotação recebem '' no próprio reindex (sem fillna por coluna)
+    alinhadas = df_anotacoes[COLUNAS_ANOTACAO].reindex(df['_chave'].to_numpy(), fill_value='')
+    for col in COLUNAS_ANOTACAO: df[col] = alinhadas[col].array
+    return df
+
 def reset_app_state(engine):
-    st.cache_data.clear() 
+    # Apenas as anotações mudaram: o cache das planilhas continua válido
+    carregar_dados_banco.clear()
     if 'df_principal' in st.session_state:
-        df_principal_antigo = st.session_state['df_principal']
         df_anotacoes_novo, df_contratacoes_novo = carregar_dados_banco(engine)
-        colunas_anotacao = ['nome_usuario', 'categoria', 'justificativa']
-        df_sem_anotacoes = df_principal_antigo.drop(columns=[col for col in colunas_anotacao if col in df_principal_antigo.columns])
-        df_principal_atualizado = pd.merge(df_sem_anotacoes, df_anotacoes_novo, on='id_registro_original', how='left')
-        for col in colunas_anotacao:
-            if col in df_principal_atualizado.columns:
-                df_principal_atualizado[col] = df_principal_atualizado[col].fillna('')
-        st.session_state['df_principal'] = df_principal_atualizado
+        st.session_state['df_principal'] = mesclar_anotacoes(st.session_state['df_principal'], df_anotacoes_novo)
         st.session_state['df_contratacoes'] = df_contratacoes_novo
-        if 'df_anotacao_original_indexed' in st.session_state:
-            del st.session_state['df_anotacao_original_indexed']
+        st.session_state['versao_dados'] = uuid.uuid4().hex
+        st.session_state.pop('chave_editor', None)
     st.rerun()
 
-@st.cache_data
-def converte_df_para_csv(df):
-    return df.to_csv(index=False, sep=';', encoding='utf-8-sig').encode('utf-8-sig')
+# Cache em disco (Parquet) que sobrevive a reinícios do servidor; falhas de E/S apenas desativam o cache
+DIR_CACHE = os.path.join(tempfile.gettempdir(), 'panorama_rh')
+# Arquivos sem uso há mais que isso (outras planilhas, sobras de versões anteriores) são apagados na próxima gravação
+IDADE_MAX_CACHE_S = 7 * 24 * 3600
+
+def chave_cache(prefixo, *partes):
+    return f"{prefixo}_{hashlib.sha1('|'.join(map(str, partes)).encode('utf-8')).hexdigest()[:16]}"
+
+def preparar_dir_cache():
+    # Snapshots têm dados de RH: diretório privado do usuário do processo (0o700). Se a pasta for de outro
+    # usuário o chmod falha e o chamador desativa o cache em vez de ler ou gravar ali
+    os.makedirs(DIR_CACHE, mode=0o700, exist_ok=True)
+    os.chmod(DIR_CACHE, 0o700)
+
+def ler_cache_parquet(chave):
+    caminho = os.path.join(DIR_CACHE, f"{chave}.parquet")
+    if not os.path.exists(caminho): return None
+    try:
+        preparar_dir_cache()
+        df = pd.read_parquet(caminho)
+        # string[pyarrow] volta do Parquet como string[python]: restaura o armazenamento Arrow da carga a frio
+        for col in df.select_dtypes(include='string').columns: df[col] = df[col].astype('string[pyarrow]')
+        return df
+    except: return None
 
-@st.cache_data
-def converter_hora_para_decimal(tempo_str):
-    if pd.isna(tempo_str) or tempo_str in ['00:00:00', '']: return 0.0
+def gravar_cache_parquet(chave, df):
     try:
-        partes = str(tempo_str).split(':')
-        horas = int(partes[0]); minutos = int(partes[1]); segundos = int(partes[2]) if len(partes) > 2 else 0
-        return horas + (minutos / 60) + (segundos / 3600)
-    except: return 0.0
+        preparar_dir_cache()
+        prefixo = chave.rsplit('_', 1)[0] + '_'
+        limite = time.time() - IDADE_MAX_CACHE_S
+        for antigo in os.listdir(DIR_CACHE):
+            caminho = os.path.join(DIR_CACHE, antigo)
+            # Revisões anteriores da mesma chave e arquivos velhos de qualquer tipo; outra carga em paralelo
+            # pode já ter apagado o arquivo, o que não impede esta gravação
+            try:
+                if antigo.startswith(prefixo) or os.path.getmtime(caminho) < limite: os.remove(caminho)
+            except OSError: pass
+        df.to_parquet(os.path.join(DIR_CACHE, f"{chave}.parquet"), compression='zstd', index=False)
+    except: pass
+
+def revisao_planilha(planilha):
+    # modifiedTime do Drive que o open() por título já trouxe na listagem de arquivos (sem outra requisição);
+    # Spreadsheet.lastUpdateTime está depreciado no gspread 6 e emite DeprecationWarning a cada carga
+    return getattr(planilha, '_properties', {}).get('modifiedTime')
+
+# Com UNFORMATTED_VALUE a API devolve números nativos; só células digitadas como texto chegam como str
+def mascara_texto(serie):
+    return serie.map(type).eq(str).to_numpy()
+
+def coluna_numerica(serie):
+    # Números já chegam como float; textos (ex.: "R$ 1.234,56") passam pelo parser pt-BR
+    eh_texto = mascara_texto(serie)
+    valores = pd.to_numeric(serie.mask(eh_texto), errors='coerce')
+    if eh_texto.any():
+        texto = serie[eh_texto].astype('string[pyarrow]').str.replace(r'[R$\s.]', '', regex=True).str.replace(',', '.', regex=False)
+        valores[eh_texto] = pd.to_numeric(texto, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    # Dinheiro fica em float64: float32 (~7 dígitos) já arredonda centavos em valores na casa dos milhares
+    return valores.fillna(0.0).astype('float64')
+
+def coluna_data(serie):
+    # SERIAL_NUMBER: datas chegam como dias desde 30/12/1899; textos seguem o formato dd/mm/aaaa
+    eh_texto = mascara_texto(serie)
+    dias = np.floor(pd.to_numeric(serie.mask(eh_texto), errors='coerce'))
+    datas = pd.Timestamp('1899-12-30') + pd.to_timedelta(dias, unit='D')
+    if eh_texto.any():
+        # exact=False tolera um horário após a data
+        datas[eh_texto] = pd.to_datetime(serie[eh_texto], errors='coerce', format='%d/%m/%Y', exact=False)
+    # Sempre à meia-noite: filtros por dia viram comparação de igualdade
+    return datas.dt.normalize()
+
+def coluna_hora_para_decimal(serie):
+    # Durações chegam como fração do dia (SERIAL_NUMBER); textos "HH:MM[:SS]" vetorizados; vazios e inválidos viram 0
+    eh_texto = mascara_texto(serie)
+    horas = pd.to_numeric(serie.mask(eh_texto), errors='coerce') * 24.0
+    if eh_texto.any():
+        # Split vetorizado em horas/minutos/segundos; vazios e partes inválidas viram NaN
+        partes = serie[eh_texto].astype(str).str.strip().str.split(':', n=2, expand=True).reindex(columns=range(3))
+        h, m, seg = (pd.to_numeric(partes[i], errors='coerce') for i in range(3))
+        horas[eh_texto] = (h + m.fillna(0) / 60.0 + seg.fillna(0) / 3600.0).to_numpy()
+    return horas.fillna(0.0).astype('float32')
+
+# Horas decimais -> "H:MM" para exibição (negativas como "-H:MM")
+def horas_para_texto(horas):
+    minutos = np.rint(horas.to_numpy(dtype='float64') * 60).astype('int64')
+    # divmod no valor absoluto: np.divmod arredonda para -inf e -30 min viraria "-1:30"
+    h, m = np.divmod(np.abs(minutos), 60)
+    sinal = pd.Series(np.where(minutos < 0, '-', ''), index=horas.index)
+    return sinal + pd.Series(h, index=horas.index).astype(str) + ':' + pd.Series(m, index=horas.index).astype(str).str.zfill(2)
 
 def format_BRL(valor):
+    # Formatação pt-BR em aritmética inteira de centavos: sem locale.setlocale (global, com lock) por chamada
     try:
-        locale.setlocale(locale.LC_ALL, 'pt_BR.UTF-8')
-        return locale.currency(valor, grouping=True, symbol=True)
-    except:
-        if isinstance(valor, (int, float)):
-            return f"R$ {valor:_.2f}".replace('.', ',').replace('_', '.')
+        centavos_total = int(round(float(valor) * 100))
+    except (TypeError, ValueError, OverflowError):
         return "R$ 0,00"
+    sinal = '-' if centavos_total < 0 else ''
+    inteiro, centavos = divmod(abs(centavos_total), 100)
+    return f"R$ {sinal}{inteiro:,}".replace(',', '.') + f",{centavos:02d}"
+
+def format_BRL_serie(serie):
+    # Versão vetorizada de format_BRL para colunas inteiras (sem locale por linha):
+    # cada valor distinto é formatado uma única vez e o resultado é distribuído via map
+    valores = serie.fillna(0).round(2)
+    return valores.map({v: format_BRL(float(v)) for v in valores.unique()})
 
 def format_horas_decimal(horas_decimais):
     try:
@@ -188,107 +333,273 @@ def format_horas_decimal(horas_decimais):
         return f"{horas_inteiras:,}".replace(",", ".") + f":{minutos:02d}h"
     except: return "Inválido"
 
+# Soma por coluna category direto nos códigos inteiros (np.bincount): equivale a
+# groupby(observed=True).sum() sem o despacho por grupo do pandas; acumula em float64
+def somar_por_categoria(categorias, valores):
+    codigos = categorias.cat.codes.to_numpy()
+    validos = codigos >= 0
+    n = len(categorias.cat.categories)
+    somas = np.bincount(codigos[validos], weights=valores.to_numpy()[validos], minlength=n)
+    presentes = np.bincount(codigos[validos], minlength=n) > 0
+    return pd.Series(somas[presentes], index=categorias.cat.categories[presentes].rename(categorias.name), name=valores.name)
+
+# A API omite células vazias no fim da linha: completa com '' (como o get_all_records) até o tamanho do cabeçalho
+def completar_linhas(linhas, n):
+    return [l[:n] if len(l) >= n else l + [''] * (n - len(l)) for l in linhas]
+
+# Nomes finais das colunas resolvidos direto do cabeçalho cru (strip/lower + renomeação numa só passada)
+def normalizar_cabecalho(cabecalho, renomear=None):
+    renomear = renomear or {}
+    return [renomear.get(c, c) for c in (str(h).strip().lower() for h in cabecalho)]
+
+# Converte a matriz crua da API (1ª linha = cabeçalho) em DataFrame
+def valores_para_df(valores, renomear=None):
+    if not valores: return pd.DataFrame()
+    return pd.DataFrame(completar_linhas(valores[1:], len(valores[0])), columns=normalizar_cabecalho(valores[0], renomear))
+
+# Monta o DataFrame só com as colunas pedidas (1ª ocorrência de cada título), sem alocar as demais
+def colunas_de_valores(valores, colunas):
+    if not valores: return pd.DataFrame(columns=colunas)
+    cabecalho = normalizar_cabecalho(valores[0])
+    posicoes = [cabecalho.index(c) for c in colunas]
+    return pd.DataFrame([[l[i] if i < len(l) else '' for i in posicoes] for l in valores[1:]], columns=colunas)
+
 @st.cache_data(ttl=300, show_spinner="Carregando dados de horas extras...")
-def carregar_horas_e_operacao(_gs_client, nome_planilha):
+def carregar_horas_e_operacao(_planilha, nome_planilha, revisao):
     try:
-        planilha = _gs_client.open(nome_planilha)
-        MAPA_FILIAIS = {'VAL': 'Valinhos', 'RIB': 'Ribeirão', 'MAR': 'Marília', 'JAC': 'Jacareí', 'GRU': 'Guarulhos'}        
-        lista_dfs = []
+        MAPA_FILIAIS = {'VAL': 'Valinhos', 'RIB': 'Ribeirão', 'MAR': 'Marília', 'JAC': 'Jacareí', 'GRU': 'Guarulhos'}
+        RENOMEAR_HORAS = {'colaborador': 'nome', 'função': 'funcao', 'salario base': 'salario_base', 'qtd he 50%': 'qtd_he_50%', 'qtd he 100%': 'qtd_he_100%', 'valor he 50%': 'valor_he_50%', 'valor he 100%': 'valor_he_100%', 'valor total': 'valor_total'}
+        abas = list(MAPA_FILIAIS) + ['OPERACAO']
+        # Uma única chamada values:batchGet para todas as abas, em vez de uma requisição por aba
+        # Valores crus (números e datas seriais) em vez do texto formatado "R$ 1.234,56" / "dd/mm/aaaa"
+        intervalos = com_retentativa(lambda: _planilha.values_batch_get(
+            [f"'{aba}'" for aba in abas],
+            params={'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'SERIAL_NUMBER'},
+        )).get('valueRanges', [])
+        valores = {aba: vr.get('values', []) for aba, vr in zip(abas, intervalos)}
+
+        # Acumula as linhas de todas as filiais e materializa um único DataFrame por layout de cabeçalho
+        # (normalmente as abas compartilham o mesmo layout e só um DataFrame é criado)
+        blocos = {}
         for nome_aba in MAPA_FILIAIS:
-            registros = planilha.worksheet(nome_aba).get_all_records(head=1)
-            if registros:
-                df_temp = pd.DataFrame(registros)
-                df_temp['filial'] = nome_aba
-                lista_dfs.append(df_temp)
+            vals = valores.get(nome_aba)
+            if not vals or len(vals) < 2: continue
+            linhas, filiais = blocos.setdefault(tuple(normalizar_cabecalho(vals[0], RENOMEAR_HORAS)), ([], []))
+            linhas.extend(completar_linhas(vals[1:], len(vals[0])))
+            filiais.extend([nome_aba] * (len(vals) - 1))
 
-        if not lista_dfs: return pd.DataFrame()
-        
-        df_horas = pd.concat(lista_dfs, ignore_index=True)
-        df_operacao = pd.DataFrame(planilha.worksheet('OPERACAO').get_all_records(head=1))
+        if not blocos: return pd.DataFrame()
 
-        df_horas.columns = [str(col).strip().lower() for col in df_horas.columns]
-        df_operacao.columns = [str(col).strip().lower() for col in df_operacao.columns]
-        
-        df_horas.rename(columns={'colaborador': 'nome', 'função': 'funcao', 'salario base': 'salario_base', 'qtd he 50%': 'qtd_he_50%', 'qtd he 100%': 'qtd_he_100%', 'valor he 50%': 'valor_he_50%', 'valor he 100%': 'valor_he_100%', 'valor total': 'valor_total'}, inplace=True)
-        df_operacao.rename(columns={'função': 'funcao'}, inplace=True)
+        lista_dfs = []
+        for cabecalho, (linhas, filiais) in blocos.items():
+            df_bloco = pd.DataFrame(linhas, columns=list(cabecalho))
+            df_bloco['filial'] = pd.Categorical(filiais, categories=list(MAPA_FILIAIS))
+            lista_dfs.append(df_bloco)
+        df_horas = lista_dfs[0] if len(lista_dfs) == 1 else pd.concat(lista_dfs, ignore_index=True, copy=False)
+        # Da OPERACAO só nome e cargo entram no merge: materializa apenas essas duas colunas da matriz crua
+        df_operacao = colunas_de_valores(valores.get('OPERACAO'), ['nome', 'cargo'])
+
+        # Cabeçalhos repetidos na planilha (ex.: colunas sem título) são a origem de colunas duplicadas
+        if not df_horas.columns.is_unique: df_horas = df_horas.loc[:, ~df_horas.columns.duplicated()]
         
-        df_horas['nome'] = df_horas['nome'].astype(str).str.strip().str.upper()
-        df_operacao['nome'] = df_operacao['nome'].astype(str).str.strip().str.upper()
-
-        for col in ['valor_he_50%', 'valor_he_100%', 'valor_total']:
-            if col in df_horas.columns:
-                df_horas[col] = pd.to_numeric(df_horas[col].astype(str).str.replace('R$', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False).str.strip(), errors='coerce').fillna(0)
-
-        df_horas['data'] = pd.to_datetime(df_horas['data'], errors='coerce', dayfirst=True)
+        # Strings em buffer Arrow contíguo: strip/upper, merge e groupby rodam nos kernels do pyarrow
+        df_horas['nome'] = df_horas['nome'].astype('string[pyarrow]').str.strip().str.upper()
+        df_operacao['nome'] = df_operacao['nome'].astype('string[pyarrow]').str.strip().str.upper()
+        df_operacao['cargo'] = df_operacao['cargo'].astype('string[pyarrow]')
+
+        # Valores em float64 (precisão de centavos nos totais); só as horas decimais ficam em float32
+        for col in df_horas.columns.intersection(COLUNAS_VALOR): df_horas[col] = coluna_numerica(df_horas[col])
+        for col in COLUNAS_QTD:
+            df_horas[f'{col}_dec'] = coluna_hora_para_decimal(df_horas[col])
+            df_horas[col] = horas_para_texto(df_horas[f'{col}_dec'])
+
+        df_horas['data'] = coluna_data(df_horas['data'])
         df_horas.dropna(subset=['data', 'nome'], inplace=True)
+        # Demais colunas podem misturar números e textos: padroniza como texto (o Parquet exige tipo único)
+        for col in df_horas.columns[df_horas.dtypes == object]: df_horas[col] = df_horas[col].astype('string[pyarrow]')
         
-        df_completo = pd.merge(df_horas, df_operacao[['nome', 'cargo']], on='nome', how='left')
+        # nome repetido na OPERACAO duplicaria as linhas de HE no merge: mantém o último cadastro
+        df_operacao = df_operacao.drop_duplicates('nome', keep='last')
+        # Mesmo CategoricalDtype dos dois lados: o merge casa os códigos inteiros em vez de hashear as strings
+        tipo_nome = pd.CategoricalDtype(pd.concat([df_horas['nome'], df_operacao['nome']], ignore_index=True).dropna().unique())
+        df_horas['nome'] = df_horas['nome'].astype(tipo_nome)
+        df_operacao = df_operacao.assign(nome=df_operacao['nome'].astype(tipo_nome))
+        # nome único do lado direito: join no índice em vez de montar a tabela hash do merge
+        df_completo = df_horas.join(df_operacao.set_index('nome')['cargo'], on='nome')
         df_completo['cargo'] = df_completo['cargo'].fillna('Não Classificado')
+        # Colunas de baixa cardinalidade como category: groupby/comparações operam nos códigos inteiros
+        for col in df_completo.columns.intersection(COLUNAS_CATEGORIA): df_completo[col] = df_completo[col].astype('category')
         return df_completo
     except Exception as e:
         st.error(f"Erro ao carregar dados de Horas Extras: {e}")
         return pd.DataFrame()
 
 @st.cache_data(ttl=300, show_spinner="Carregando quadro de colaboradores...")
-def carregar_colaboradores(_gs_client, nome_planilha):
+def carregar_colaboradores(_planilha, nome_planilha, revisao):
     try:
-        registros = _gs_client.open(nome_planilha).worksheet('COLABORADORES').get_all_records(head=1)
-        if not registros: return pd.DataFrame()
-        df = pd.DataFrame(registros)
-        df.columns = [str(c).lower().strip() for c in df.columns]
+        chave = chave_cache('colab', nome_planilha, revisao) if revisao else None
+        if chave:
+            df_cache = ler_cache_parquet(chave)
+            if df_cache is not None: return df_cache
+
+        # get_values devolve lista de listas: evita o dict por linha montado pelo get_all_records
+        df = valores_para_df(com_retentativa(lambda: _planilha.worksheet('COLABORADORES').get_values()))
+        if df.empty: return pd.DataFrame()
+        # Strings Arrow: trim/upper rodam nos kernels C++ e cada coluna passa uma única vez
         for col in ['filial', 'situação', 'colaborador', 'função']:
-            if col in df.columns: df[col] = df[col].str.strip()
-        df['situação'] = df['situação'].str.upper()
-        df['colaborador'] = df['colaborador'].str.upper()
+            if col not in df.columns: continue
+            serie = df[col].astype('string[pyarrow]').str.strip()
+            serie = serie.str.upper() if col in ('situação', 'colaborador') else serie
+            # Poucos valores distintos (filial/situação/função): category compara e agrupa pelos códigos inteiros
+            df[col] = serie if col == 'colaborador' else serie.astype('category')
+        if chave: gravar_cache_parquet(chave, df)
         return df
     except: return pd.DataFrame()
 
-@st.cache_data(ttl=300, show_spinner="Buscando dados do banco...")
+@st.cache_data(ttl=60, show_spinner="Buscando dados do banco...")
 def carregar_dados_banco(_engine):
-    df_ano, df_cont = pd.DataFrame(), pd.DataFrame()
-    if not _engine: return df_ano, df_cont
-    try:
-        with _engine.connect() as conn:
-            df_ano = pd.DataFrame(conn.execute(text("SELECT id_registro_original, nome_usuario, categoria, justificativa FROM anotacoes")).fetchall(), columns=['id_registro_original', 'nome_usuario', 'categoria', 'justificativa'])
-            df_cont = pd.DataFrame(conn.execute(text("""WITH RankedRH AS (SELECT filial_descricao, contratacoes_pendentes, ROW_NUMBER() OVER(PARTITION BY filial_descricao ORDER BY data_registro DESC, id DESC) as rn FROM rh_duplicate) SELECT filial_descricao, contratacoes_pendentes FROM RankedRH WHERE rn = 1;""")).fetchall(), columns=['filial_descricao', 'contratacoes_pendentes'])
-    except Exception as e: st.error(f"Erro ao buscar dados: {e}")
+    if not _engine: return pd.DataFrame(), pd.DataFrame()
+    def consultar(sql, dtype):
+        # Cada consulta em sua própria conexão do pool; read_sql preenche os arrays tipados direto do cursor
+        try:
+            with _engine.connect() as conn: return pd.read_sql(text(sql), conn, dtype=dtype)
+        except Exception as e:
+            st.error(f"Erro ao buscar dados: {e}")
+            return pd.DataFrame()
+    # As duas consultas são independentes: a latência total é a da mais lenta, não a soma
+    df_ano, df_cont = executar_em_paralelo(
+        lambda: consultar("SELECT id_registro_original, nome_usuario, categoria, justificativa FROM anotacoes",
+                          {'id_registro_original': 'string', 'nome_usuario': 'string', 'categoria': 'string', 'justificativa': 'string'}),
+        # Último registro por filial: DISTINCT ON resolve com um único sort, sem ROW_NUMBER sobre todas as linhas
+        lambda: consultar("SELECT DISTINCT ON (filial_descricao) filial_descricao, contratacoes_pendentes FROM rh_duplicate ORDER BY filial_descricao, data_registro DESC, id DESC;",
+                          {'filial_descricao': 'string', 'contratacoes_pendentes': 'Int32'}),
+    )
+    if not df_ano.empty:
+        # Índice por _chave montado uma vez aqui (resultado em cache) e reaproveitado a cada junção
+        df_ano = df_ano.set_index(chave_registro(df_ano['id_registro_original']).rename('_chave'))
+        df_ano = df_ano[~df_ano.index.duplicated(keep='last')].fillna({col: '' for col in COLUNAS_ANOTACAO})
     return df_ano, df_cont
 
+def executar_em_paralelo(*tarefas):
+    # Cargas de E/S independentes (Sheets e Postgres) em threads; o contexto do script é repassado
+    # para que st.cache_data, spinners e st.error continuem funcionando dentro delas
+    ctx = get_script_run_ctx()
+    def rodar(tarefa):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return tarefa()
+    with ThreadPoolExecutor(max_workers=len(tarefas)) as executor:
+        return list(executor.map(rodar, tarefas))
+
 @st.cache_data(ttl=300, show_spinner="Sincronizando dados...")
+def carregar_planilhas(_gs_client, nome_planilha):
+    # Só dados do Google Sheets: salvar anotações não invalida este cache
+    try:
+        # Planilha aberta uma única vez; a revisão (modifiedTime do Drive) entra na chave dos caches
+        planilha = _gs_client.open(nome_planilha)
+        revisao = revisao_planilha(planilha)
+    except Exception as e:
+        st.error(f"Erro ao abrir a planilha: {e}")
+        return None, pd.DataFrame()
+
+    # Snapshot do resultado já preparado (ids, _chave, período): num reinício do servidor nada é recalculado
+    chave = chave_cache('horas', 'v4', nome_planilha, revisao) if revisao else None
+    df_horas = ler_cache_parquet(chave) if chave else None
+    if df_horas is not None:
+        return df_horas, carregar_colaboradores(planilha, nome_planilha, revisao)
+
+    df_horas, df_colab = executar_em_paralelo(
+        lambda: carregar_horas_e_operacao(planilha, nome_planilha, revisao),
+        lambda: carregar_colaboradores(planilha, nome_planilha, revisao),
+    )
+
+    if df_horas.empty: return None, df_colab
+
+    # datetime64[D] -> str já produz 'AAAA-MM-DD' num único cast vetorizado, sem strftime por elemento
+    dias = df_horas['data'].to_numpy().astype('datetime64[D]').astype(str)
+    df_horas['id_registro_original'] = df_horas['nome'].astype(str) + '_' + pd.Series(dias, index=df_horas.index)
+    df_horas['_chave'] = chave_registro(df_horas['id_registro_original'])
+
+    # Período comercial: dias após o 20 contam no mês seguinte (dezembro vira janeiro do ano seguinte)
+    datas = df_horas['data'].dt
+    dia, mes, ano = datas.day.to_numpy(), datas.month.to_numpy(), datas.year.to_numpy()
+    vira = dia > 20
+    # int16/int8 bastam para ano e mês: filtros da sidebar comparam arrays 2-4x menores
+    df_horas['ano_comercial'] = np.where(vira & (mes == 12), ano + 1, ano).astype('int16')
+    df_horas['mes_comercial'] = np.where(vira, mes % 12 + 1, mes).astype('int8')
+    if chave: gravar_cache_parquet(chave, df_horas)
+    return df_horas, df_colab
+
 def carregar_e_processar_dados_iniciais(_gs_client, _engine, nome_planilha):
-    df_horas = carregar_horas_e_operacao(_gs_client, nome_planilha)
-    df_colab = carregar_colaboradores(_gs_client, nome_planilha)
-    df_ano, df_cont = carregar_dados_banco(_engine)
+    # Latência total = a da carga mais lenta (Sheets ou banco), não a soma
+    (df_horas, df_colab), (df_ano, df_cont) = executar_em_paralelo(
+        lambda: carregar_planilhas(_gs_client, nome_planilha),
+        lambda: carregar_dados_banco(_engine),
+    )
 
-    if df_horas.empty: return None, None, None
+    if df_horas is None: return None, None, None
 
-    df_horas['qtd_he_50%_dec'] = df_horas['qtd_he_50%'].apply(converter_hora_para_decimal)
-    df_horas['qtd_he_100%_dec'] = df_horas['qtd_he_100%'].apply(converter_hora_para_decimal)
-    df_horas['id_registro_original'] = df_horas['nome'].astype(str) + '_' + df_horas['data'].dt.strftime('%Y-%m-%d')
-    
-    if not df_ano.empty:
-        df = pd.merge(df_horas, df_ano, on='id_registro_original', how='left')
-    else:
-        df = df_horas.copy()
-        df['nome_usuario'] = None; df['categoria'] = ''; df['justificativa'] = ''
-
-    df['nome_usuario'] = df['nome_usuario'].fillna('')
-    df['categoria'] = df['categoria'].fillna('')
-    df['justificativa'] = df['justificativa'].fillna('')
-    df = df.loc[:, ~df.columns.duplicated()]
-
-    def det_periodo(data):
-        if data.day > 20:
-            dp = data + pd.DateOffset(months=1)
-            return dp.year, dp.month
-        return data.year, data.month
-    
-    df[['ano_comercial', 'mes_comercial']] = df['data'].apply(lambda d: pd.Series(det_periodo(d)))
+    df = mesclar_anotacoes(df_horas, df_ano)
     return df, df_colab, df_cont
 
+# Índice (ano, mês, filial) ordenado: os filtros da sidebar viram fatias do índice em vez de máscaras
+# sobre o frame inteiro (níveis com prefixo _ para não colidir com as colunas homônimas nos groupby)
+def indexar_por_periodo(df):
+    indice = pd.MultiIndex.from_arrays([df['ano_comercial'], df['mes_comercial'], df['filial']], names=['_ano', '_mes', '_filial'])
+    return df.set_axis(indice).sort_index()
+
+def mapear_periodos(df):
+    # {ano comercial: [meses disponíveis]} — calculado uma vez por carga, não a cada interação da sidebar
+    meses = df.groupby('ano_comercial')['mes_comercial'].unique()
+    return {int(ano): sorted(int(m) for m in lista) for ano, lista in meses.items()}
+
 # ==============================================================================
 # 📊 LÓGICA DO DASHBOARD PRINCIPAL
 # ==============================================================================
+# Mapas fixos de exibição e seus inversos (selectbox devolve o rótulo; os filtros usam a chave)
+MESES_PT = {1:'Janeiro', 2:'Fevereiro', 3:'Março', 4:'Abril', 5:'Maio', 6:'Junho', 7:'Julho', 8:'Agosto', 9:'Setembro', 10:'Outubro', 11:'Novembro', 12:'Dezembro'}
+MESES_PT_REV = {v: k for k, v in MESES_PT.items()}
+MAPA_FILIAIS_EXIBICAO = {'Valinhos': 'Valinhos', 'Ribeirao': 'Ribeirão', 'Marilia': 'Marília', 'Jacareí': 'Jacareí', 'Guarulhos': 'Guarulhos'}
+MAPA_FILIAIS_EXIBICAO_REV = {v: k for k, v in MAPA_FILIAIS_EXIBICAO.items()}
+
+# Mês comercial: 21 do mês anterior até 20 do mês
+def legenda_periodo(ano, mes):
+    ano_ini, mes_ini = (ano - 1, 12) if mes == 1 else (ano, mes - 1)
+    return f"Período: **21/{mes_ini:02d}/{ano_ini}** a **20/{mes:02d}/{ano}**"
+
+# Agregações por filtro: o DataFrame não entra no hash (prefixo _); a chave é a versão dos dados
+# (nova a cada carga ou salvamento) + os filtros, então reruns de outros widgets reaproveitam o resultado
+@st.cache_data(show_spinner=False, max_entries=64)
+def calcular_kpis(_df, versao, filtros):
+    # Horas ficam em float32: os totais saem de um único bloco float64 somado por coluna
+    total_he_geral, total_he_50, total_he_100, horas_50, horas_100 = _df[
+        ['valor_total', 'valor_he_50%', 'valor_he_100%', 'qtd_he_50%_dec', 'qtd_he_100%_dec']
+    ].to_numpy(dtype='float64').sum(axis=0)
+    return {
+        'total_he_geral': total_he_geral, 'total_he_50': total_he_50, 'total_he_100': total_he_100,
+        'total_horas_dec': horas_50 + horas_100,
+        # Distintos sobre os códigos inteiros da categoria nome (sem materializar as strings)
+        'colabs_he': len(pd.unique(_df['nome'].cat.codes.to_numpy()[_df['valor_total'].to_numpy() > 0])),
+    }
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def calcular_custo_por_cargo(_df, versao, filtros):
+    return somar_por_categoria(_df['cargo'], _df['valor_total']).sort_values(ascending=True).reset_index()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def calcular_custo_diario(_df, versao, filtros, por_filial):
+    if not por_filial: return _df.groupby('data')['valor_total'].sum().reset_index()
+    custo_dia = _df.groupby(['data', 'filial'], observed=True)['valor_total'].sum().reset_index()
+    custo_dia['filial'] = custo_dia['filial'].map(lambda f: MAPA_FILIAIS_EXIBICAO.get(f, f))
+    return custo_dia
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def calcular_nao_classificados(_df, versao, filtros):
+    df_nc = _df[(_df['cargo'] == 'Não Classificado').to_numpy()]
+    if df_nc.empty: return df_nc
+    res = df_nc.groupby(['nome', 'filial'], observed=True).agg(Custo=('valor_total','sum'), Ocorrencias=('nome','count')).reset_index()
+    res['Custo'] = format_BRL_serie(res['Custo'])
+    return res.rename(columns={'nome':'Colaborador','filial':'Filial'})
+
 def run_dashboard():
     # ─── HEADER EXECUTIVO ───────────────────────────────
     st.markdown(
@@ -308,16 +619,18 @@ def run_dashboard():
     NOME_DA_PLANILHA = "bdBANCO DE HORAS"
 
     if 'data_loaded' not in st.session_state:
-        gs_client = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
-        df, df_colab, df_cont = carregar_e_processar_dados_iniciais(gs_client, engine, NOME_DA_PLANILHA)
+        df, df_colab, df_cont = carregar_e_processar_dados_iniciais(obter_cliente_gs(), engine, NOME_DA_PLANILHA)
         
         if df is None:
             st.warning("Não há dados de horas extras válidos para exibir.")
             st.stop()
             
+        df = indexar_por_periodo(df)
         st.session_state['df_principal'] = df
         st.session_state['df_colaboradores'] = df_colab
         st.session_state['df_contratacoes'] = df_cont
+        st.session_state['periodos'] = mapear_periodos(df)
+        st.session_state['versao_dados'] = uuid.uuid4().hex
         st.session_state['data_loaded'] = True
 
     df = st.session_state['df_principal']
@@ -331,61 +644,59 @@ def run_dashboard():
         if st.button("🚪 Sair", use_container_width=True): logout()
         if st.button("🔄 Forçar Sincronização", use_container_width=True):
             st.cache_data.clear()
-            for k in ['data_loaded', 'df_principal', 'df_colaboradores', 'df_contratacoes']:
+            for k in ['data_loaded', 'df_principal', 'df_colaboradores', 'df_contratacoes', 'periodos']:
                 if k in st.session_state: del st.session_state[k]
             st.rerun()
             
         st.markdown("---")
         st.markdown("<div style='font-size:0.75rem; font-weight:700; color:#5C677D; text-transform:uppercase; margin-bottom:8px;'>📅 Período de Análise</div>", unsafe_allow_html=True)
 
-        meses_pt = {1:'Janeiro', 2:'Fevereiro', 3:'Março', 4:'Abril', 5:'Maio', 6:'Junho', 7:'Julho', 8:'Agosto', 9:'Setembro', 10:'Outubro', 11:'Novembro', 12:'Dezembro'}
-        anos_disp = sorted(df['ano_comercial'].unique(), reverse=True)
+        periodos = st.session_state['periodos']
+        anos_disp = sorted(periodos, reverse=True)
         ano_sel = st.selectbox("Ano", anos_disp, index=0)
         
-        df_ano = df[df['ano_comercial'] == ano_sel]
-        meses_disp = sorted(df_ano['mes_comercial'].unique())
-        meses_nomes = ['Todos'] + [meses_pt[m] for m in meses_disp]
+        df_ano = df.xs(ano_sel, level='_ano', drop_level=False)
+        meses_disp = periodos[ano_sel]
+        meses_nomes = ['Todos'] + [MESES_PT[m] for m in meses_disp]
 
-        hoje = datetime.now()
-        dt_ref = hoje + pd.DateOffset(months=1) if hoje.day > 20 else hoje
+        # Mês comercial de hoje em aritmética de inteiros (após o dia 20 já conta o mês seguinte)
+        hoje = date.today()
+        ano_ref, mes_ref = (hoje.year + hoje.month // 12, hoje.month % 12 + 1) if hoje.day > 20 else (hoje.year, hoje.month)
         idx_padrao = 0
-        if ano_sel == dt_ref.year and meses_pt.get(dt_ref.month) in meses_nomes:
-            idx_padrao = meses_nomes.index(meses_pt.get(dt_ref.month))
+        if ano_sel == ano_ref and MESES_PT.get(mes_ref) in meses_nomes:
+            idx_padrao = meses_nomes.index(MESES_PT.get(mes_ref))
             
         mes_sel = st.selectbox("Mês", meses_nomes, index=idx_padrao)
         
         if mes_sel == 'Todos':
-            df_periodo = df_ano.copy()
+            df_periodo = df_ano
             st.caption(f"Exibindo ano **{ano_sel}**.")
         else:
-            mes_num = next(k for k, v in meses_pt.items() if v == mes_sel)
-            df_periodo = df_ano[df_ano['mes_comercial'] == mes_num].copy()
-            dt_fim = pd.to_datetime(f'{ano_sel}-{mes_num}-20')
-            dt_ini = (dt_fim - pd.DateOffset(months=1)).replace(day=21)
-            st.caption(f"Período: **{dt_ini.strftime('%d/%m/%Y')}** a **{dt_fim.strftime('%d/%m/%Y')}**")
+            mes_num = MESES_PT_REV[mes_sel]
+            df_periodo = df.xs((ano_sel, mes_num), level=['_ano', '_mes'], drop_level=False)
+            st.caption(legenda_periodo(ano_sel, mes_num))
 
-        mapa_filiais = {'Valinhos': 'Valinhos', 'Ribeirao': 'Ribeirão', 'Marilia': 'Marília', 'Jacareí': 'Jacareí', 'Guarulhos': 'Guarulhos'}
         filiais_disp = sorted(df_periodo['filial'].unique().tolist())
-        nomes_filiais = ['Todas'] + [mapa_filiais.get(c, c) for c in filiais_disp]
+        nomes_filiais = ['Todas'] + [MAPA_FILIAIS_EXIBICAO.get(c, c) for c in filiais_disp]
         filial_sel = st.selectbox("Filial", nomes_filiais)
 
-        df_filtrado = df_periodo.copy()
+        df_filtrado = df_periodo
         if filial_sel != 'Todas':
-            rev_map = {v: k for k, v in mapa_filiais.items()}
-            cod_sel = rev_map.get(filial_sel, filial_sel)
-            df_filtrado = df_periodo[df_periodo['filial'] == cod_sel].copy()
+            cod_sel = MAPA_FILIAIS_EXIBICAO_REV.get(filial_sel, filial_sel)
+            df_filtrado = df_periodo.xs(cod_sel, level='_filial', drop_level=False)
 
     if df_filtrado.empty:
         st.warning("Nenhum dado encontrado para os filtros selecionados.")
         st.stop()
+    # Linhas com custo: máscara única reaproveitada pelo detalhe por cargo e pelas anotações
+    mask_positivo = df_filtrado['valor_total'].to_numpy() > 0
 
     # --- CÁLCULOS KPI ---
-    total_he_geral = df_filtrado['valor_total'].sum()
+    versao, filtros = st.session_state['versao_dados'], (ano_sel, mes_sel, filial_sel)
+    kpis = calcular_kpis(df_filtrado, versao, filtros)
+    total_he_geral, total_he_50, total_he_100 = kpis['total_he_geral'], kpis['total_he_50'], kpis['total_he_100']
+    total_horas_dec, colabs_he = kpis['total_horas_dec'], kpis['colabs_he']
     custo_c_encargos = total_he_geral * 1.16 
-    total_he_50 = df_filtrado['valor_he_50%'].sum()
-    total_he_100 = df_filtrado['valor_he_100%'].sum()
-    total_horas_dec = df_filtrado['qtd_he_50%_dec'].sum() + df_filtrado['qtd_he_100%_dec'].sum()
-    colabs_he = df_filtrado[df_filtrado['valor_total'] > 0]['nome'].nunique()
 
     tot_pendentes = 0
     if not df_contratacoes.empty:
@@ -397,13 +708,15 @@ def run_dashboard():
     tot_ativos, tot_inativos, tot_geral = 0, 0, 0
     lista_ativos_df, lista_inativos_df = pd.DataFrame(), pd.DataFrame()
     if not df_colaboradores.empty:
-        df_c_f = df_colaboradores[df_colaboradores['filial'] == filial_sel] if filial_sel != 'Todas' else df_colaboradores.copy()
+        df_c_f = df_colaboradores[df_colaboradores['filial'] == filial_sel] if filial_sel != 'Todas' else df_colaboradores
         if not df_c_f.empty:
-            lista_ativos_df = df_c_f[df_c_f['situação'] == 'TRABALHANDO']
-            lista_inativos_df = df_c_f[df_c_f['situação'] != 'TRABALHANDO']
-            tot_ativos = len(lista_ativos_df)
-            tot_inativos = len(lista_inativos_df)
+            # Uma única comparação de situação; inativos são o complemento da mesma máscara
+            mask_ativos = (df_c_f['situação'] == 'TRABALHANDO').to_numpy(dtype=bool, na_value=False)
+            lista_ativos_df = df_c_f[mask_ativos]
+            lista_inativos_df = df_c_f[~mask_ativos]
             tot_geral = len(df_c_f)
+            tot_ativos = int(mask_ativos.sum())
+            tot_inativos = tot_geral - tot_ativos
 
     # --- SEÇÃO 1: KPIs PRINCIPAIS ---
     c1, c2, c3 = st.columns(3)
@@ -447,18 +760,22 @@ def run_dashboard():
 
         if st.session_state.selected_cargo:
             st.markdown(f"**Detalhamento: {st.session_state.selected_cargo}**")
-            df_det = df_filtrado[(df_filtrado['cargo'] == st.session_state.selected_cargo) & (df_filtrado['valor_total'] > 0)].copy()
-            df_det['Data'] = pd.to_datetime(df_det['data']).dt.strftime('%d/%m/%Y')
-            df_det['Valor'] = df_det['valor_total'].apply(format_BRL)
+            # Só as colunas exibidas; assign devolve um frame novo sem cópia defensiva do recorte inteiro
+            # Predicados combinados in-place no próprio array da comparação: nenhum array booleano temporário extra
+            mask_det = (df_filtrado['cargo'] == st.session_state.selected_cargo).to_numpy()
+            mask_det &= mask_positivo
+            df_det = df_filtrado.loc[mask_det, ['data', 'nome', 'filial', 'valor_total']]
+            df_det = df_det.assign(Data=df_det['data'].dt.strftime('%d/%m/%Y'), Valor=format_BRL_serie(df_det['valor_total']))
             st.dataframe(df_det[['Data', 'nome', 'filial', 'Valor']].rename(columns={'nome':'Colaborador','filial':'Filial'}), use_container_width=True, hide_index=True)
             if st.button("⬅️ Voltar"):
                 st.session_state.selected_cargo = None
                 st.rerun()
         else:
-            custo_cargo = df_filtrado.groupby('cargo')['valor_total'].sum().sort_values(ascending=True).reset_index()
+            custo_cargo = calcular_custo_por_cargo(df_filtrado, versao, filtros)
             fig_bar = go.Figure(go.Bar(
                 x=custo_cargo['valor_total'], y=custo_cargo['cargo'], orientation='h',
-                marker_color=C["cyan"], text=custo_cargo['valor_total'].apply(format_BRL), textposition='auto',
+                # Rótulo formatado pelo próprio Plotly (separators=",." no layout): sem lista de strings no JSON do gráfico
+                marker_color=C["cyan"], texttemplate='R$ %{x:,.2f}', textposition='auto',
                 hovertemplate='<b>%{y}</b><br>Custo: R$ %{x:,.2f}<extra></extra>'
             ))
             fig_bar.update_layout(**plotly_layout(height=400, margin=dict(l=0, r=0, t=10, b=0)))
@@ -473,11 +790,10 @@ def run_dashboard():
     with cg2:
         sec("📈 Evolução do Custo Diário")
         if filial_sel == 'Todas':
-            custo_dia = df_periodo.groupby(['data', 'filial'])['valor_total'].sum().reset_index()
-            custo_dia['filial'] = custo_dia['filial'].map(mapa_filiais).fillna(custo_dia['filial'])
+            custo_dia = calcular_custo_diario(df_periodo, versao, filtros, True)
             fig_line = px.line(custo_dia, x='data', y='valor_total', color='filial', markers=True)
         else:
-            custo_dia = df_filtrado.groupby('data')['valor_total'].sum().reset_index()
+            custo_dia = calcular_custo_diario(df_filtrado, versao, filtros, False)
             fig_line = px.line(custo_dia, x='data', y='valor_total', markers=True)
             fig_line.update_traces(line_color=C["cyan"])
 
@@ -495,28 +811,42 @@ def run_dashboard():
         st.write("")
         ver_todas = st.checkbox("Exibir mês completo (ignora filtro de data)")
 
-    df_anotar = df_filtrado[df_filtrado['valor_total'] > 0].copy() if ver_todas else df_filtrado[(df_filtrado['data'].dt.date == dt_anotacao) & (df_filtrado['valor_total'] > 0)].copy()
+    usr_atual = usuario_logado.get('nome', '').strip()
+    # Frames do editor guardados na sessão: só são remontados quando dados (versao), filtros, data ou usuário mudam;
+    # digitar no editor ou abrir expanders reaproveita os mesmos frames
+    chave_editor = (versao, filtros, ver_todas, None if ver_todas else dt_anotacao, usr_atual)
+    if st.session_state.get('chave_editor') != chave_editor:
+        if ver_todas:
+            df_edit = df_filtrado[mask_positivo].copy()
+        else:
+            # 'data' já sai do loader sem horário: igualdade direta de int64 nos datetime64, sem materializar .dt.date
+            mask_dia = df_filtrado['data'].to_numpy() == np.datetime64(dt_anotacao, 'ns')
+            mask_dia &= mask_positivo
+            df_edit = df_filtrado[mask_dia].copy()
 
-    if df_anotar.empty:
-        st.info("Nenhuma hora extra registrada para os filtros selecionados.")
-    else:
-        df_edit = df_anotar.copy()
-        df_edit['Data'] = pd.to_datetime(df_edit['data']).dt.strftime('%d/%m/%Y')
-        df_edit['Valor'] = df_edit['valor_total'].apply(format_BRL)
+        df_edit['Data'] = df_edit['data'].dt.strftime('%d/%m/%Y')
+        df_edit['Valor'] = format_BRL_serie(df_edit['valor_total'])
         df_edit.rename(columns={'nome': 'Colaborador', 'cargo': 'Cargo', 'qtd_he_50%': 'HE 50%', 'qtd_he_100%': 'HE 100%', 'categoria': 'Categoria', 'justificativa': 'Justificativa'}, inplace=True)
         df_edit.set_index('id_registro_original', inplace=True)
-        
-        st.session_state['df_anotacao_original_indexed'] = df_edit.copy()
-        usr_atual = usuario_logado.get('nome', '').strip()
-        
+
         mask_edit = (df_edit['nome_usuario'].fillna('').str.strip() == '') | (df_edit['nome_usuario'].fillna('').str.casefold() == usr_atual.casefold())
-        df_meus = df_edit[mask_edit].copy()
-        df_outros = df_edit[~mask_edit].copy()
-        
-        df_meus['Gestor'] = df_meus['nome_usuario'].apply(lambda x: x.strip() if str(x).strip() else '—')
-        df_outros['Gestor'] = df_outros['nome_usuario'].apply(lambda x: x.strip() if str(x).strip() else '—')
-        
-        st.session_state['df_anotacao_original_indexed_meus'] = df_meus.copy()
+        df_meus = df_edit[mask_edit]
+        df_outros = df_edit[~mask_edit]
+        df_meus = df_meus.assign(Gestor=df_meus['nome_usuario'].apply(lambda x: x.strip() if str(x).strip() else '—'))
+        df_outros = df_outros.assign(Gestor=df_outros['nome_usuario'].apply(lambda x: x.strip() if str(x).strip() else '—'))
+
+        st.session_state['df_anotacao_original_indexed'] = df_edit
+        st.session_state['df_anotacao_original_indexed_meus'] = df_meus
+        st.session_state['df_anotacao_outros'] = df_outros
+        st.session_state['chave_editor'] = chave_editor
+
+    df_edit = st.session_state['df_anotacao_original_indexed']
+    df_meus = st.session_state['df_anotacao_original_indexed_meus']
+    df_outros = st.session_state['df_anotacao_outros']
+
+    if df_edit.empty:
+        st.info("Nenhuma hora extra registrada para os filtros selecionados.")
+    else:
         cols_exib = ['Data', 'Colaborador', 'Cargo', 'HE 50%', 'HE 100%', 'Valor', 'Categoria', 'Justificativa', 'Gestor']
         ops_cat = ["", "Absenteísmo", "Quadro de colaboradores", "Cliente", "Operações", "Outros"]
 
@@ -537,12 +867,12 @@ def run_dashboard():
         if st.button("✔️ Salvar Anotações", type="primary"):
             try:
                 df_orig_m = st.session_state['df_anotacao_original_indexed_meus']
-                df_editado_meus.index = df_orig_m.index
-                
-                alt = df_editado_meus[
-                    (df_editado_meus['Categoria'].fillna('') != df_orig_m['Categoria'].fillna('')) |
-                    (df_editado_meus['Justificativa'].fillna('') != df_orig_m['Justificativa'].fillna(''))
-                ]
+                # Editor e original têm as mesmas linhas na mesma ordem: compara os arrays posição a posição,
+                # sem alinhar índices, e só as linhas alteradas recebem o id_registro_original
+                mask_alt = np.zeros(len(df_orig_m), dtype=bool)
+                for col in ('Categoria', 'Justificativa'):
+                    mask_alt |= df_editado_meus[col].fillna('').to_numpy(dtype=object) != df_orig_m[col].fillna('').to_numpy(dtype=object)
+                alt = df_editado_meus[mask_alt].set_axis(df_orig_m.index[mask_alt])
                 
                 if not alt.empty:
                     # Linha alterada que tem motivo mas não tem justificativa -> inválida
@@ -553,20 +883,26 @@ def run_dashboard():
                         st.stop()
 
                 if not alt.empty:
+                    cats = alt['Categoria'].fillna('').str.strip()
+                    juss = alt['Justificativa'].fillna('').str.strip()
+                    vazias = (cats == '') & (juss == '')
+                    ids_deletar = alt.index[vazias].tolist()
+                    params_upsert = [
+                        {"id": id_reg, "usr": usr_atual, "cat": cat, "jus": jus}
+                        for id_reg, cat, jus in zip(alt.index[~vazias], cats[~vazias], juss[~vazias])
+                    ]
                     with st.spinner("Salvando..."), engine.begin() as conn:
-                        for id_reg, linha in alt.iterrows():
-                            cat = (linha['Categoria'] or "").strip()
-                            jus = (linha['Justificativa'] or "").strip()
-                            if not cat and not jus:
-                                conn.execute(text("DELETE FROM anotacoes WHERE id_registro_original = :id"), {"id": id_reg})
-                            else:
-                                conn.execute(text("""
-                                    INSERT INTO anotacoes (id_registro_original, nome_usuario, categoria, justificativa) 
-                                    VALUES (:id, :usr, :cat, :jus)
-                                    ON CONFLICT (id_registro_original) DO UPDATE SET 
-                                        categoria = EXCLUDED.categoria, justificativa = EXCLUDED.justificativa,
-                                        nome_usuario = EXCLUDED.nome_usuario, data_modificacao = NOW();
-                                """), {"id": id_reg, "usr": usr_atual, "cat": cat, "jus": jus})
+                        # Uma instrução por tipo de operação: DELETE com ANY e UPSERT via executemany
+                        if ids_deletar:
+                            conn.execute(text("DELETE FROM anotacoes WHERE id_registro_original = ANY(:ids)"), {"ids": ids_deletar})
+                        if params_upsert:
+                            conn.execute(text("""
+                                INSERT INTO anotacoes (id_registro_original, nome_usuario, categoria, justificativa) 
+                                VALUES (:id, :usr, :cat, :jus)
+                                ON CONFLICT (id_registro_original) DO UPDATE SET 
+                                    categoria = EXCLUDED.categoria, justificativa = EXCLUDED.justificativa,
+                                    nome_usuario = EXCLUDED.nome_usuario, data_modificacao = NOW();
+                            """), params_upsert)
                     st.success("Anotações salvas com sucesso!")
                     reset_app_state(engine)
                 else:
@@ -574,36 +910,61 @@ def run_dashboard():
             except Exception as e: st.error(f"Erro ao salvar: {e}")
 
         # --- DIAGNÓSTICO DE NOMES ---
-        df_nc = df_filtrado[df_filtrado['cargo'] == 'Não Classificado']
-        if not df_nc.empty:
+        res_nc = calcular_nao_classificados(df_filtrado, versao, filtros)
+        if not res_nc.empty:
             st.markdown("---")
             sec("🚨 Colaboradores Não Mapeados")
             st.caption("Nomes que realizaram HE mas não foram encontrados na aba OPERACAO do sistema.")
-            res = df_nc.groupby(['nome', 'filial']).agg(Custo=('valor_total','sum'), Ocorrencias=('nome','count')).reset_index()
-            res['Custo'] = res['Custo'].apply(format_BRL)
-            st.dataframe(res.rename(columns={'nome':'Colaborador','filial':'Filial'}), use_container_width=True, hide_index=True)
+            st.dataframe(res_nc, use_container_width=True, hide_index=True)
 
 # ==============================================================================
 # INÍCIO DO APLICATIVO
 # ==============================================================================
-# Injeção CSS para tela de login (Esconde a Sidebar)
+# Tela de login: CSS (esconde a sidebar e centraliza o cartão limitando a largura, sem colunas vazias)
+# e espaçamento superior saem num único st.markdown
+HTML_LOGIN_PAGINA = """<style>[data-testid="stSidebar"], [data-testid="collapsedControl"] { display: none !important; }
+    [data-testid="stMainBlockContainer"], .block-container { max-width: 520px; }</style><br><br><br>"""
+
+# Cabeçalho estático do cartão de login
+HTML_LOGIN_CABECALHO = (
+    f"<div style='text-align:center; margin-bottom:20px;'><h2 style='color:{C['deep']};'>🔐 Autenticação</h2>"
+    f"<p style='color:{C['muted']};'>Insira as suas credenciais para acessar o painel de RH.</p></div>"
+)
+
+LOGIN_MAX_FALHAS, LOGIN_JANELA_S = 5, 30
+
+# Formulário de login como fragmento: envios com falha reexecutam só este bloco;
+# o st.rerun() do login bem-sucedido (escopo "app" por padrão) recarrega a página inteira já com o dashboard
+@st.fragment
+def tela_login():
+    with st.container(border=True):
+        st.markdown(HTML_LOGIN_CABECALHO, unsafe_allow_html=True)
+        with st.form("login_form_central"):
+            email = st.text_input("📧 **Email**")
+            senha = st.text_input("🔑 **Senha**", type="password")
+            st.markdown("<br>", unsafe_allow_html=True)
+            if st.form_submit_button("Acessar Painel", use_container_width=True, type="primary"):
+                # Envio vazio (ex.: Enter no primeiro campo) nem chega ao banco
+                if not (email and senha):
+                    st.error("Preencha email e senha.")
+                    return
+                # Limite de falhas por email na sessão: após LOGIN_MAX_FALHAS dentro da janela, recusa sem consultar o banco
+                tentativas = st.session_state.setdefault('_tentativas_login', {})
+                chave, agora = email.strip().lower(), time.monotonic()
+                falhas, inicio = tentativas.get(chave, (0, agora))
+                if agora - inicio >= LOGIN_JANELA_S: falhas, inicio = 0, agora
+                if falhas >= LOGIN_MAX_FALHAS:
+                    st.error(f"Muitas tentativas. Aguarde {int(LOGIN_JANELA_S - (agora - inicio)) + 1}s.")
+                elif user_info := authenticate_user(email, senha):
+                    tentativas.pop(chave, None)
+                    st.session_state['user'] = user_info
+                    st.rerun()
+                else:
+                    tentativas[chave] = (falhas + 1, inicio)
+                    st.error("Email ou senha inválidos.")
+
 if not get_logged_user():
-    st.markdown("""<style>[data-testid="stSidebar"], [data-testid="collapsedControl"] { display: none !important; }</style>""", unsafe_allow_html=True)
-    
-    col1, col2, col3 = st.columns([1, 1.5, 1])
-    with col2:
-        st.markdown("<br><br><br>", unsafe_allow_html=True)
-        with st.container(border=True):
-            st.markdown(f"<div style='text-align:center; margin-bottom:20px;'><h2 style='color:{C['deep']};'>🔐 Autenticação</h2><p style='color:{C['muted']};'>Insira as suas credenciais para acessar o painel de RH.</p></div>", unsafe_allow_html=True)
-            with st.form("login_form_central"):
-                email = st.text_input("📧 **Email**")
-                senha = st.text_input("🔑 **Senha**", type="password")
-                st.markdown("<br>", unsafe_allow_html=True)
-                if st.form_submit_button("Acessar Painel", use_container_width=True, type="primary"):
-                    user_info = authenticate_user(email, senha)
-                    if user_info:
-                        st.session_state['user'] = user_info
-                        st.rerun()
-                    else: st.error("Email ou senha inválidos.")
+    st.markdown(HTML_LOGIN_PAGINA, unsafe_allow_html=True)
+    tela_login()
 else:
     run_dashboard()
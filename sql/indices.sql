@@ -0,0 +1,10 @@
+-- Índices usados pelas consultas do dashboard (app.py). Executar uma vez no Supabase (SQL Editor).
+
+-- Contratações pendentes: último registro por filial (SELECT DISTINCT ON ... ORDER BY filial_descricao, data_registro DESC, id DESC)
+CREATE INDEX IF NOT EXISTS idx_rh_duplicate_filial_data
+    ON rh_duplicate (filial_descricao, data_registro DESC, id DESC);
+
+-- Login: busca do usuário por e-mail sem diferenciar maiúsculas (WHERE lower(email) = lower(:email)).
+-- Falha se já existirem e-mails repetidos só na caixa; nesse caso, unificar os cadastros antes.
+CREATE UNIQUE INDEX IF NOT EXISTS usuarios_email_lower_uq
+    ON usuarios (lower(email));